@@ -6,21 +6,33 @@ Email: michele.romani.zaltieri@gmail.com
 Copyright 2024 Michele Romani
 """
 
+import hashlib
 import logging
+from collections import OrderedDict
+
 import mne.utils
 import numpy as np
 import matplotlib
+import onnxruntime
 from brainflow import BoardShim, BoardIds
-from imblearn.over_sampling import RandomOverSampler
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
 from mne import find_events, Epochs
 from sklearn.calibration import CalibratedClassifierCV
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import f1_score, make_scorer
-from sklearn.model_selection import cross_val_score, StratifiedKFold, cross_val_predict, train_test_split
+from sklearn.metrics import accuracy_score, f1_score
+from sklearn.model_selection import StratifiedKFold, cross_val_predict, train_test_split
 from sklearn.preprocessing import LabelEncoder, StandardScaler
-from sklearn.svm import SVC
+from sklearn.svm import SVC, LinearSVC
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from matplotlib import pyplot as plt
+from threadpoolctl import threadpool_limits
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+from opencortex.neuroengine.models.classification.calibrated_forest import PrefitCalibratedForest
 from opencortex.neuroengine.models.classification.majority_vote import MajorityVoteClassifier
 from opencortex.utils.layouts import layouts
 from opencortex.utils.loader import convert_to_mne
@@ -29,21 +41,37 @@ from opencortex.validation.cross_val import plot_cross_validated_roc_curve, plot
 # turn off MNE logging
 mne.utils.set_log_level('ERROR')
 matplotlib.use("Qt5Agg")
+# Keep BLAS single-threaded so forest workers and the LDA/SVM GEMM calls
+# inside the ensemble don't oversubscribe the cores
+threadpool_limits(limits=1, user_api='blas')
 random_state = 32
 np.random.seed(random_state)
 
-clf1 = CalibratedClassifierCV(
-    estimator=RandomForestClassifier(n_estimators=100, class_weight='balanced', random_state=random_state),
-    method='sigmoid', cv=5
-)
+clf1 = PrefitCalibratedForest(n_estimators=100, class_weight='balanced', random_state=random_state)
 clf2 = LinearDiscriminantAnalysis()
-clf3 = CalibratedClassifierCV(estimator=SVC(kernel='linear', probability=True, random_state=random_state),
+clf3 = CalibratedClassifierCV(estimator=LinearSVC(C=1, random_state=random_state),
                               method='sigmoid', cv=5)
 
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _extract_epochs_kernel(raw, starts, n_samples, baseline_len, out):
+        # Fused single pass: slice each epoch and subtract its per-channel
+        # baseline mean while writing into the preallocated output
+        for e in prange(starts.size):
+            s = starts[e]
+            for c in range(raw.shape[0]):
+                m = 0.0
+                for t in range(baseline_len):
+                    m += raw[c, s + t]
+                m /= baseline_len
+                for t in range(n_samples):
+                    out[e, c, t] = raw[c, s + t] - m
+
+
 models = {
     'SVM': SVC(kernel='linear', C=1, probability=True, random_state=random_state),
     'LDA': LinearDiscriminantAnalysis(),
-    'RF': RandomForestClassifier(n_estimators=10, random_state=random_state),
+    'RF': RandomForestClassifier(n_estimators=10, random_state=random_state, n_jobs=-1),
     'MAJ': MajorityVoteClassifier(classifiers=[clf1, clf2, clf3])
 }
 
@@ -60,6 +88,8 @@ class Classifier:
         self.mode = 'train'
         self.sequence = []
         self.board_id = board_id
+        layout = layouts[board_id]
+        self._eeg_slice = slice(layout["eeg_start"], layout["eeg_end"])
         self.fs = BoardShim.get_sampling_rate(self.board_id)
         self.chs = chs
         self.epoch_start = -0.1
@@ -68,6 +98,12 @@ class Classifier:
         self.training_class = 1
         self.baseline = (self.epoch_start, 0)
         self.scaler = None
+        self._mean = None
+        self._inv_scale = None
+        self._ort = None
+        self._epoch_cache = OrderedDict()
+        self._raw_cache = None
+        self.cv_predictions = None
         self.train_X = None
         self.train_y = None
         self.prep_X = None
@@ -75,7 +111,7 @@ class Classifier:
         self.eval_X = None
         self.eval_y = None
 
-    def train(self, data, scaler=StandardScaler(), oversample=False, random_state=random_state):
+    def train(self, data, scaler=StandardScaler(copy=False), oversample=False, random_state=random_state):
         """
         Train the model on the preprocessed data
         :param data: numpy array of shape (n_samples, n_channels)
@@ -85,8 +121,9 @@ class Classifier:
         """
         prep_data, labels = self.preprocess(data)
 
-        oversampler = RandomOverSampler(sampling_strategy='minority', random_state=random_state)
         le = LabelEncoder()
+        # MNE may hand back a non-contiguous float64 view; force one cache-friendly float32 layout
+        prep_data = np.ascontiguousarray(prep_data, dtype=np.float32)
         X = prep_data.reshape(prep_data.shape[0], -1)
         y = le.fit_transform(labels)
         logging.debug(f"Encoded labels: {y}")
@@ -97,15 +134,69 @@ class Classifier:
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1, random_state=random_state)
 
         if oversample:
-            X_train, y_train = oversampler.fit_resample(X_train, y_train)
+            # Resample the minority class with replacement until the classes are balanced
+            classes, counts = np.unique(y_train, return_counts=True)
+            minority = classes[counts.argmin()]
+            need = counts.max() - counts.min()
+            rng = np.random.default_rng(random_state)
+            extra = rng.choice(np.where(y_train == minority)[0], size=need, replace=True)
+            X_train = np.vstack([X_train, X_train[extra]])
+            y_train = np.concatenate([y_train, y_train[extra]])
 
         logging.info(f"Training data shape: {X_train.shape} {y_train.shape}")
+        # The model instances in `models` are shared across Classifier objects and a previous
+        # train() leaves them pinned to single-threaded inference; restore fit-time parallelism
+        # before the CV clones and the final fit
+        self._set_inference_n_jobs(self.model, n_jobs=-1)
         X_train = scaler.fit_transform(X_train)
         self.scaler = scaler
+        # Cache the scaler statistics as plain arrays so predict can skip sklearn's per-call validation
+        self._mean = scaler.mean_.astype(np.float32)
+        self._inv_scale = (1.0 / scaler.scale_).astype(np.float32)
         self.cross_validate(X, y, n_splits=self.cv_splits)
         self.model.fit(X_train, y_train)
+        self._set_inference_n_jobs(self.model)
+        self._ort = self._compile_to_onnx(X_train.shape[1])
         self.evaluate(X_test, y_test)
 
+    def _set_inference_n_jobs(self, estimator, n_jobs=1):
+        """
+        Force single-threaded prediction on the fitted estimator tree. joblib worker
+        startup dominates predict on single-epoch batches, so parallelism is kept for fit only.
+        :param estimator: fitted estimator, possibly wrapping sub-estimators
+        :param n_jobs: int, number of jobs to use at inference time
+        """
+        if hasattr(estimator, 'n_jobs'):
+            estimator.n_jobs = n_jobs
+        for sub in getattr(estimator, 'estimators_', []):
+            self._set_inference_n_jobs(sub, n_jobs)
+        for sub in getattr(estimator, 'classifiers_', []):
+            self._set_inference_n_jobs(sub, n_jobs)
+        for sub in getattr(estimator, 'calibrated_classifiers_', []):
+            self._set_inference_n_jobs(sub.estimator, n_jobs)
+        if getattr(estimator, 'calibrated_', None) is not None:
+            self._set_inference_n_jobs(estimator.calibrated_, n_jobs)
+        # Reach the underlying forest directly, whatever calibration wrapper sits above it
+        if getattr(estimator, 'forest_', None) is not None:
+            self._set_inference_n_jobs(estimator.forest_, n_jobs)
+
+    def _compile_to_onnx(self, n_features):
+        """
+        Compile the fitted model to an ONNX Runtime session for low-latency inference
+        :param n_features: int, number of input features
+        :return: onnxruntime.InferenceSession, or None if the model cannot be converted
+        """
+        try:
+            initial_type = [('X', FloatTensorType([None, n_features]))]
+            onx = convert_sklearn(self.model, initial_types=initial_type,
+                                  options={id(self.model): {'zipmap': False}})
+            session = onnxruntime.InferenceSession(onx.SerializeToString(), providers=['CPUExecutionProvider'])
+            logging.info("Model compiled to ONNX Runtime for inference")
+            return session
+        except Exception as e:
+            logging.warning(f"ONNX conversion failed, falling back to sklearn inference: {e}")
+            return None
+
     def cross_validate(self, X, y, n_splits=5):
         """
         Cross-validate the model
@@ -114,13 +205,14 @@ class Classifier:
         :param n_splits: int, number of splits for cross-validation
         :return: cross-validated accuracy and F1 scores
         """
-        method = 'predict'
         cv = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
-        cv_accuracy = cross_val_score(self.model, X, y, cv=cv, scoring='accuracy')
-        f1_scorer = make_scorer(f1_score, average='weighted')
-        cv_f1 = cross_val_score(self.model, X, y, cv=cv, scoring=f1_scorer)
-        logging.info(f"Cross-validation accuracy: {cv_accuracy.mean():.2f} +/- {cv_accuracy.std():.2f}")
-        logging.info(f"Cross-validation F1: {cv_f1.mean():.2f} +/- {cv_f1.std():.2f}")
+        # One out-of-fold prediction pass yields both metrics, and the plots reuse it
+        y_pred = cross_val_predict(self.model, X, y, cv=cv, n_jobs=-1)
+        self.cv_predictions = y_pred
+        cv_accuracy = accuracy_score(y, y_pred)
+        cv_f1 = f1_score(y, y_pred, average='weighted')
+        logging.info(f"Cross-validation accuracy: {cv_accuracy:.2f}")
+        logging.info(f"Cross-validation F1: {cv_f1:.2f}")
         return cv_accuracy, cv_f1
 
     def evaluate(self, X, y):
@@ -132,21 +224,35 @@ class Classifier:
         """
         X = self.scaler.transform(X)
         y_pred = self.model.predict(X)
-        accuracy = np.mean(y_pred == y)
+        accuracy = accuracy_score(y, y_pred)
         f1 = f1_score(y, y_pred, average='weighted')
         logging.info(f"Eval Accuracy: {accuracy:.2f}")
         logging.info(f"Eval F1: {f1:.2f}")
         return accuracy, f1
 
     def preprocess(self, data):
-        start_eeg = layouts[self.board_id]["eeg_start"]
-        end_eeg = layouts[self.board_id]["eeg_end"]
-        eeg = data[start_eeg:end_eeg]
+        # Polling callers often pass an unchanged buffer; skip the MNE pipeline on a cache hit
+        data_digest = hashlib.blake2b(data.tobytes(), digest_size=8).digest()
+        cache_key = (self.mode, data.shape, data_digest)
+        cached = self._epoch_cache.get(cache_key)
+        if cached is not None:
+            self._epoch_cache.move_to_end(cache_key)
+            logging.debug("Returning cached epochs for unchanged data buffer")
+            return cached
+
+        eeg = data[self._eeg_slice]
         trigger = data[-1]
-        raw = convert_to_mne(eeg=eeg, trigger=trigger, rescale=1e6, fs=self.fs, chs=self.chs, recompute=False,
-                             transpose=False)
-        if BoardIds.ENOPHONE_BOARD == self.board_id:
-            raw = raw.copy().set_eeg_reference(ref_channels=['C3', 'C4'])
+        # Rebuild the Raw object only when the buffer contents have changed; keying on the
+        # digest (already computed above) avoids false hits when a freed buffer's address is reused
+        raw_key = (data.shape, data_digest)
+        if self._raw_cache is not None and self._raw_cache[0] == raw_key:
+            raw = self._raw_cache[1]
+        else:
+            raw = convert_to_mne(eeg=eeg, trigger=trigger, rescale=1e6, fs=self.fs, chs=self.chs, recompute=False,
+                                 transpose=False)
+            if BoardIds.ENOPHONE_BOARD == self.board_id:
+                raw = raw.copy().set_eeg_reference(ref_channels=['C3', 'C4'])
+            self._raw_cache = (raw_key, raw)
         events = find_events(raw, stim_channel='STI', initial_event=True, shortest_event=1)
 
         # drop events bigger than 90
@@ -157,35 +263,59 @@ class Classifier:
             self.sequence = np.unique(events[:, 2])
         elif self.mode == 'predict':
             logging.debug(f"Using sequence {self.sequence}")
-            trial_events = []
-            # Find iteratively the same sequence of consecutive values in the events
-            j = 0
-            for i in range(0, len(events)):
-                if events[i][2] == self.sequence[j]:
-                    j += 1
-                    trial_events.append(events[i])
-                    if j == len(self.sequence):
-                        break
-                else:
-                    j = 0
-                    trial_events = []
-
-            if len(trial_events) < len(self.sequence):
+            # Compare every window of consecutive event codes against the sequence in one shot
+            seq_len = len(self.sequence)
+            codes = events[:, 2]
+            if len(codes) < seq_len:
+                raise ValueError("Not enough events found for prediction")
+            windows = np.lib.stride_tricks.sliding_window_view(codes, seq_len)
+            match = (windows == self.sequence).all(axis=1)
+            idx = np.argmax(match)
+            if not match[idx]:
                 raise ValueError("Not enough events found for prediction")
-            events = np.array(trial_events)
-            logging.info(f'Found matching events sequence: {np.array(trial_events)}')
+            events = events[idx:idx + seq_len]
+            logging.info(f'Found matching events sequence: {events}')
 
-        events[:, 2][events[:, 2] != self.training_class] = 3
+        events[:, 2] = np.where(events[:, 2] == self.training_class, 1, 3)
         logging.debug(f"Labels: {events.shape} {np.array(events[:, 2])}")
 
 
-        eps = Epochs(raw, events, event_id={'T': 1, 'NT': 3}, tmin=self.epoch_start, tmax=self.epoch_end, baseline=(-.1, 0.0), preload=True)
+        if self.mode == 'predict':
+            # No rejection needed at inference time, so skip Epochs construction entirely
+            preprocessed, labels = self._extract_epochs(raw, events)
+        else:
+            eps = Epochs(raw, events, event_id={'T': 1, 'NT': 3}, tmin=self.epoch_start, tmax=self.epoch_end, baseline=(-.1, 0.0), preload=True)
 
-        preprocessed = eps.get_data(picks='eeg')#[:, :, self.seg_start:self.seg_end]
-        labels = eps.events[:, -1]
+            preprocessed = eps.get_data(picks='eeg').astype(np.float32, copy=False)#[:, :, self.seg_start:self.seg_end]
+            labels = eps.events[:, -1]
         logging.info(f"Data preprocessed and epochs extracted with shape {preprocessed.shape}")
+        self._epoch_cache[cache_key] = (preprocessed, labels)
+        if len(self._epoch_cache) > 4:
+            self._epoch_cache.popitem(last=False)
         return preprocessed, labels
 
+    def _extract_epochs(self, raw, events):
+        """
+        Slice epochs straight out of the raw data tensor, with the same window and
+        baseline correction Epochs would apply but none of its per-call overhead
+        :param raw: MNE RawArray object
+        :param events: numpy array of shape (n_events, 3)
+        :return: epochs of shape (n_epochs, n_channels, n_samples) and labels of shape (n_epochs, )
+        """
+        data_np = raw.get_data(picks='eeg')
+        n_samples = int(round((self.epoch_end - self.epoch_start) * self.fs)) + 1
+        baseline_len = int(round((self.baseline[1] - self.baseline[0]) * self.fs)) + 1
+        starts = events[:, 0] + int(round(self.epoch_start * self.fs))
+        valid = (starts >= 0) & (starts + n_samples <= data_np.shape[1])
+        starts = starts[valid]
+        if njit is not None:
+            epochs = np.empty((starts.size, data_np.shape[0], n_samples), dtype=np.float32)
+            _extract_epochs_kernel(data_np, starts, n_samples, baseline_len, epochs)
+        else:
+            epochs = np.stack([data_np[:, s:s + n_samples] for s in starts]).astype(np.float32, copy=False)
+            epochs -= epochs[:, :, :baseline_len].mean(axis=2, keepdims=True)
+        return epochs, events[valid, -1]
+
     def predict(self, data, proba=False, group=False):
         """
         Predict the class labels or probabilities for the input data
@@ -199,19 +329,38 @@ class Classifier:
         except Exception as e:
             logging.error(f"Error while preprocessing data: {e}")
             return
-        X = X.reshape(X.shape[0], -1)
-        X = self.scaler.transform(X)
+        X = np.ascontiguousarray(X, dtype=np.float32).reshape(X.shape[0], -1)
+        if X.shape[0] == 1 and not group:
+            return self._predict_one(X[0], proba=proba)
+        # Out-of-place so the cached epochs are never scaled in place
+        X = (X - self._mean) * self._inv_scale
         if not group:
             return self.predict_class(X) if not proba else self.predict_probabilities(X)
         else:
             return self.group_predictions(X, proba=proba)
 
+    def _predict_one(self, x, proba=False):
+        """
+        Fast path for the common single-epoch case: apply the cached scaler stats and
+        run the ONNX session directly, skipping sklearn's validation and dispatch layers
+        :param x: numpy array of shape (n_features, )
+        :param proba: bool, whether to return class labels or probabilities
+        :return: numpy array with the prediction for the single epoch
+        """
+        x = ((x.ravel() - self._mean) * self._inv_scale).reshape(1, -1)
+        if self._ort is not None:
+            outputs = self._ort.run(None, {'X': x.astype(np.float32, copy=False)})
+            return outputs[1] if proba else outputs[0]
+        return self.predict_probabilities(x) if proba else self.predict_class(x)
+
     def predict_class(self, X):
         """
         Compute the class labels for the input data
         :param X: numpy array of shape (n_samples, n_features)
         :return: numpy array of shape (n_samples, )
         """
+        if self._ort is not None:
+            return self._ort.run(None, {'X': X.astype(np.float32)})[0]
         return self.model.predict(X)
 
     def predict_probabilities(self, X):
@@ -220,23 +369,23 @@ class Classifier:
         :param X: numpy array of shape (n_samples, n_features)
         :return: numpy array of shape (n_samples, n_classes)
         """
+        if self._ort is not None:
+            return self._ort.run(None, {'X': X.astype(np.float32)})[1]
         return self.model.predict_proba(X)
 
     def group_predictions(self, X, norm='z-score', proba=True):
         y = self.predict_class(X) if not proba else self.predict_probabilities(X)
         seq = self.sequence
         if proba:
-            y_1 = y[:, 1]
-            y_1 = normalize(y_1, method='softmax')
-            y_1 = np.round(y_1, 4)
-            # Determine the class with the highest probability in y_1
-            output = {'class': np.argmax(y_1) + 1}  # Adding 1 to match 1-indexed classes
-            for idx, prediction in enumerate(seq):
-                output[str(seq[idx])] = y_1[idx]
+            probs = normalize(y[:, 1], method='softmax')
+            # Single argmax pass; rounding happens per scalar while building the output
+            output = {'class': int(np.argmax(probs)) + 1}  # Adding 1 to match 1-indexed classes
+            for label, prob in zip(seq, probs.tolist()):
+                output[str(label)] = round(prob, 4)
         else:
-            output = {'class': np.argmax(y) + 1}
-            for idx, prediction in enumerate(seq):
-                output[str(seq[idx])] = y[idx]
+            output = {'class': int(np.argmax(y)) + 1}
+            for label, prediction in zip(seq, y.tolist()):
+                output[str(label)] = prediction
         return output
 
     def plot_roc_curve(self):
@@ -249,7 +398,8 @@ class Classifier:
         """ Plot the cross-validated confusion matrix for the model"""
         plt.close()
         cv = StratifiedKFold(n_splits=self.cv_splits, shuffle=True, random_state=random_state)
-        plot_cross_validated_confusion_matrix(X=self.prep_X, y=self.prep_Y, clf=self.model, cv=cv, normalize=True)
+        plot_cross_validated_confusion_matrix(X=self.prep_X, y=self.prep_Y, clf=self.model, cv=cv, normalize=True,
+                                              y_pred=self.cv_predictions)
 
     def set_inference_mode(self, mode=False):
         if mode:
@@ -0,0 +1,78 @@
+import os
+
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import train_test_split
+
+try:
+    from sklearn.frozen import FrozenEstimator
+except ImportError:  # scikit-learn < 1.6
+    FrozenEstimator = None
+
+
+class PrefitCalibratedForest(BaseEstimator, ClassifierMixin):
+    """ A sigmoid-calibrated random forest fitted once on a holdout split.
+
+    CalibratedClassifierCV with cv=k refits the forest k times; here the
+    forest is fitted a single time on 90% of the data and Platt-scaled
+    on the remaining 10% via cv='prefit', which is ~k times faster with
+    negligible calibration-quality loss.
+
+    Parameters
+    ----------
+    n_estimators : int
+    Number of trees in the forest.
+    class_weight : dict, 'balanced' or None
+    Passed through to RandomForestClassifier.
+    calibration_size : float
+    Fraction of the training data held out for calibration.
+    random_state : int or None
+    Controls the holdout split and the forest.
+    """
+
+    def __init__(self, n_estimators=100, class_weight='balanced', calibration_size=0.1, random_state=None):
+        self.n_estimators = n_estimators
+        self.class_weight = class_weight
+        self.calibration_size = calibration_size
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        """ Fit the forest once, then calibrate on the holdout split.
+        Parameters
+        ----------
+        X : {array-like, sparse matrix},
+        shape = [n_samples, n_features]
+        Matrix of training samples.
+        y : array-like, shape = [n_samples]
+        Vector of target class labels.
+        Returns
+        -------
+        self : object
+        """
+        X_fit, X_cal, y_fit, y_cal = train_test_split(X, y, test_size=self.calibration_size,
+                                                      stratify=y, random_state=self.random_state)
+        forest = RandomForestClassifier(n_estimators=self.n_estimators, class_weight=self.class_weight,
+                                        random_state=self.random_state, n_jobs=-1)
+        forest.fit(X_fit, y_fit)
+        # Partition the trees ~10 per prediction worker so batched predict_proba
+        # scales across cores without paying joblib overhead per tree; callers
+        # doing single-epoch inference override this back to n_jobs=1
+        forest.n_jobs = min(os.cpu_count() or 1, max(1, forest.n_estimators // 10))
+        self.forest_ = forest
+        if FrozenEstimator is not None:
+            calibrator = CalibratedClassifierCV(FrozenEstimator(forest), method='sigmoid')
+        else:
+            # cv='prefit' is deprecated in scikit-learn >= 1.6 in favor of FrozenEstimator
+            calibrator = CalibratedClassifierCV(forest, method='sigmoid', cv='prefit')
+        self.calibrated_ = calibrator.fit(X_cal, y_cal)
+        self.classes_ = self.calibrated_.classes_
+        return self
+
+    def predict(self, X):
+        """ Predict class labels for X. """
+        return self.calibrated_.predict(X)
+
+    def predict_proba(self, X):
+        """ Predict calibrated class probabilities for X. """
+        return self.calibrated_.predict_proba(X)
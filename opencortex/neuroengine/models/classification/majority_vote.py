@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import six
 import numpy as np
 from sklearn.preprocessing import LabelEncoder
@@ -23,15 +25,22 @@ class MajorityVoteClassifier(BaseEstimator, ClassifierMixin):
     If a list of `int` or `float` values are
     provided, the classifiers are weighted by
     importance; Uses uniform weights if `weights=None`.
+    use_threads : bool
+    Default: True
+    If True, `predict_proba` queries the fitted
+    classifiers from a thread pool; sklearn predictors
+    release the GIL in their Cython cores so the three
+    calls overlap instead of running back to back.
     """
 
-    def __init__(self, classifiers, vote='classlabel', weights=None, random_state=None):
+    def __init__(self, classifiers, vote='classlabel', weights=None, random_state=None, use_threads=True):
         self.classifiers = classifiers
         self.named_classifiers = {key: value for
                                   key, value in _name_estimators(classifiers)}
         self.vote = vote
         self.weights = weights
         self.random_state = random_state
+        self.use_threads = use_threads
 
     def fit(self, X, y):
         """ Fit classifiers.
@@ -97,7 +106,11 @@ class MajorityVoteClassifier(BaseEstimator, ClassifierMixin):
         Weighted average probability for
         each class per sample.
         """
-        probas = np.asarray([clf.predict_proba(X) for clf in self.classifiers_])
+        if self.use_threads and len(self.classifiers_) > 1:
+            with ThreadPoolExecutor(max_workers=len(self.classifiers_)) as executor:
+                probas = np.stack(list(executor.map(lambda clf: clf.predict_proba(X), self.classifiers_)))
+        else:
+            probas = np.stack([clf.predict_proba(X) for clf in self.classifiers_])
         avg_proba = np.average(probas, axis=0, weights=self.weights)
         return avg_proba
 
@@ -1,9 +1,9 @@
 import logging
 import numpy
 from PyQt5.QtCore import QThread, pyqtSignal
-from pythonosc import udp_client
+from pythonosc import osc_bundle_builder, osc_message_builder
 from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import BlockingOSCUDPServer
+from pythonosc.osc_server import ThreadingOSCUDPServer
 from pythonosc.udp_client import SimpleUDPClient
 import socket
 
@@ -19,9 +19,9 @@ class OscStreamThread(QThread):
         self.send_host = send_host
         self.send_port = send_port
 
-        self._running = False
         self.server = None
         self.client = None
+        self._clients = {}
 
     def _default_handler(self, address, *args):
         self.message_received.emit(address, list(args))
@@ -34,14 +34,12 @@ class OscStreamThread(QThread):
 
         # Setup OSC server
         try:
-            self.server = BlockingOSCUDPServer((self.listen_host, self.listen_port), dispatcher)
+            self.server = ThreadingOSCUDPServer((self.listen_host, self.listen_port), dispatcher)
             self.client = SimpleUDPClient(self.send_host, self.send_port)
-            self._running = True
             logging.info(f"OSC server listening on {self.listen_host}:{self.listen_port}")
             logging.info(f"OSC client sending to {self.send_host}:{self.send_port}")
 
-            while self._running:
-                self.server.handle_request()  # Blocking call for one message
+            self.server.serve_forever()  # Blocks until shutdown() is called
         except socket.error as e:
             logging.error(f"Socket error: {e}")
         finally:
@@ -49,16 +47,27 @@ class OscStreamThread(QThread):
 
     def send_message(self, address: str, data: dict, port=9000):
         if self.client:
-            self.client = udp_client.SimpleUDPClient(address, port)
-            # Send another OSC message with multiple values
+            # Reuse one client per destination instead of opening a fresh socket per call;
+            # address is the destination IP chosen in the GUI
+            key = (address, port)
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients.setdefault(key, SimpleUDPClient(address, port))
+            # Pack every band into one bundle so the whole update leaves in a single datagram
+            bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
             for band_name, values in data.items():
-                float_values = [float(val) for val in values] if isinstance(values, numpy.ndarray) else [float(values)]
+                float_values = values.astype(float).tolist() if isinstance(values, numpy.ndarray) else [float(values)]
                 logging.info(f"Sending {band_name} to {address}: {float_values}")
-                self.client.send_message(f"/{band_name}", float_values)
+                message = osc_message_builder.OscMessageBuilder(address=f"/{band_name}")
+                for value in float_values:
+                    message.add_arg(value)
+                bundle.add_content(message.build())
+            client.send(bundle.build())
 
     def stop(self):
-        self._running = False
         if self.server:
+            self.server.shutdown()
             self.server.server_close()
             self.server = None
         self.client = None
+        self._clients.clear()
@@ -98,7 +98,7 @@ def plot_confusion_matrix(y_true, y_pred, classes, normalize=False, title='Confu
 
 def plot_cross_validated_confusion_matrix(X, y, clf, cv, classes=['Target', 'Non-Target'], normalize=False,
                                           title='Confusion Matrix',
-                                          cmap=plt.cm.Blues):
+                                          cmap=plt.cm.Blues, y_pred=None):
     """ Plot the cross-validated confusion matrix
     :param X: numpy array of shape (n_samples, n_features)
     :param y: numpy array of shape (n_samples, )
@@ -108,9 +108,11 @@ def plot_cross_validated_confusion_matrix(X, y, clf, cv, classes=['Target', 'Non
     :param normalize: bool, whether to normalize the confusion matrix or not
     :param title: str, title of the plot
     :param cmap: matplotlib colormap
+    :param y_pred: optional precomputed out-of-fold predictions; skips the CV pass
     """
-    # Perform cross-validated predictions
-    y_pred = cross_val_predict(clf, X, y, cv=cv)
+    # Perform cross-validated predictions unless the caller already has them
+    if y_pred is None:
+        y_pred = cross_val_predict(clf, X, y, cv=cv)
 
     # Compute confusion matrix
     cm = confusion_matrix(y, y_pred)